@@ -5,14 +5,32 @@ This script continuously sends requests to the API server until it encounters a
 """
 
 import asyncio
-import aiohttp
-import json
+import httpx
+import numpy as np
+import orjson
 import time
-import random
 import argparse
-import statistics
+import itertools
+import logging
+import math
+import queue
+import sys
+from array import array
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
 from datetime import datetime
+from logging.handlers import QueueHandler, QueueListener
 from pathlib import Path
+from typing import NamedTuple, Optional
+
+try:
+    import uvloop  # Faster event loop, optional (not available on Windows)
+except ImportError:
+    uvloop = None
+
+logger = logging.getLogger(__name__)
+log_listener = None  # QueueListener started by setup_logging
 
 # Test sample texts of varying lengths
 SHORT_TEXT = "Hello, this is a short test message."
@@ -25,112 +43,445 @@ bottlenecks in the processing pipeline. The server should be able to handle requ
 # Available voices to cycle through
 VOICES = ["alloy", "ash", "ballad", "coral", "echo", "fable", "onyx", "nova", "sage", "shimmer", "verse"]
 
-async def send_request(session, url, voice, text_length, request_num, save_dir=None):
-    """Send a single API request and return metrics."""
+TEXTS = {"short": SHORT_TEXT, "medium": MEDIUM_TEXT, "long": LONG_TEXT}
+
+MODEL = "tts-1"
+SPEED = 1.0
+
+# Request bodies for every (text length, voice) pair, serialized once up front
+PAYLOAD_BYTES = {
+    (length, voice): orjson.dumps({"input": text, "model": MODEL, "voice": voice, "speed": SPEED})
+    for length, text in TEXTS.items()
+    for voice in VOICES
+}
+
+HEADERS = {
+    "Content-Type": "application/json",
+    "Authorization": "Bearer dummy-api-key"
+}
+
+# Responses are streamed in chunks of this size rather than buffered whole
+CHUNK_SIZE = 64 * 1024
+
+# Number of leading response bytes kept to sanity-check the audio format
+AUDIO_HEAD_SIZE = 16
+
+# Client-side LRU cache of audio responses for --cache, keyed on
+# (text_length, voice, model, speed)
+CACHE = OrderedDict()
+CACHE_MAX_ENTRIES = 1000
+
+# Results are streamed to the JSONL results file in batches of up to this many
+RESULTS_BATCH_SIZE = 256
+RESULTS_QUEUE_SIZE = 10_000
+
+class StopPhase(Exception):
+    """Raised inside a test phase's TaskGroup to cancel every request still in flight."""
+
+# Audio container expected for each response Content-Type
+CONTENT_TYPE_FORMATS = {
+    "audio/mpeg": "mpeg",
+    "audio/mp3": "mpeg",
+    "audio/aac": "mpeg",  # ADTS frames share the MPEG frame sync
+    "audio/wav": "wav",
+    "audio/wave": "wav",
+    "audio/x-wav": "wav",
+    "audio/ogg": "ogg",
+    "audio/opus": "ogg",
+    "audio/flac": "flac",
+    "audio/mp4": "mp4",
+}
+
+def sniff_audio_format(head):
+    """Guess the audio container from its leading bytes, or None if unrecognised."""
+    if head.startswith(b"ID3") or (len(head) >= 2 and head[0] == 0xFF and (head[1] & 0xE0) == 0xE0):
+        return "mpeg"
+    if head.startswith(b"RIFF") and head[8:12] == b"WAVE":
+        return "wav"
+    if head.startswith(b"OggS"):
+        return "ogg"
+    if head.startswith(b"fLaC"):
+        return "flac"
+    if head[4:8] == b"ftyp":
+        return "mp4"
+    return None
+
+def matches_content_type(content_type, head):
+    """Sanity-check that the leading bytes are audio of the declared Content-Type.
     
-    start_time = time.time()
-    request_time = datetime.now().strftime("%H:%M:%S.%f")[:-3]
+    Unknown content types only require the bytes to look like some audio format.
+    """
+    sniffed = sniff_audio_format(head)
+    expected = CONTENT_TYPE_FORMATS.get(content_type.split(";")[0].strip().lower())
+    return sniffed is not None and (expected is None or sniffed == expected)
+
+class RequestResult(NamedTuple):
+    """Outcome of a single request; `error` is None when the request succeeded."""
+    request_num: int
+    voice: str
+    status: int
+    duration: float
+    response_size: int
+    timestamp: float  # Epoch seconds when the request started
+    error: Optional[str]
+    cached: bool = False
+    warmup: bool = False
+    format_mismatch: bool = False
     
-    # Select the appropriate text based on the length parameter
-    if text_length == "short":
-        text = SHORT_TEXT
-    elif text_length == "medium":
-        text = MEDIUM_TEXT
-    else:
-        text = LONG_TEXT
+    @property
+    def success(self):
+        return self.error is None
+
+class LatencyHistogram:
+    """Constant-memory duration histogram with log-spaced buckets (HDR-histogram style).
+    
+    Each bucket spans `precision` relative width, so percentiles read from it
+    are accurate to about that fraction at any request count. Durations outside
+    [min_value, max_value] are clamped into the first or last bucket.
+    """
+    
+    def __init__(self, min_value=1e-4, max_value=1e4, precision=0.01):
+        self.min_value = min_value
+        self.growth = 1 + precision
+        self._log_growth = math.log(self.growth)
+        self.num_buckets = math.ceil(math.log(max_value / min_value) / self._log_growth) + 1
+        self.counts = array('q', bytes(8 * self.num_buckets))
+        self.total = 0
+    
+    def record(self, value):
+        if value <= self.min_value:
+            index = 0
+        else:
+            index = min(int(math.log(value / self.min_value) / self._log_growth), self.num_buckets - 1)
+        self.counts[index] += 1
+        self.total += 1
+    
+    def percentiles(self, qs):
+        """Estimate the given percentiles (0-100) from the bucket midpoints."""
+        cumulative = np.cumsum(np.frombuffer(self.counts, dtype=np.int64))
+        ranks = np.maximum(np.ceil(np.asarray(qs, dtype=np.float64) / 100 * self.total), 1)
+        indices = np.searchsorted(cumulative, ranks)
+        return self.min_value * self.growth ** (indices + 0.5)
+
+class RunStats:
+    """Running summary of request results in constant memory.
+    
+    Durations feed Welford's online mean/variance and a LatencyHistogram for
+    percentiles; otherwise only counters and the first few failures are kept.
+    """
     
-    # Prepare the request payload
-    payload = {
-        "input": text,
-        "model": "tts-1",
-        "voice": voice,
-        "speed": 1.0
-    }
+    MAX_FAILURES = 5
+    
+    def __init__(self):
+        self.total = 0
+        self.successful = 0
+        self.failed = 0
+        self.cache_hits = 0
+        self.format_mismatches = 0
+        self.mean_duration = 0.0
+        self._m2_duration = 0.0
+        self.min_duration = math.inf
+        self.max_duration = -math.inf
+        self.size_sum = 0
+        self.histogram = LatencyHistogram()
+        self.failures = []
+    
+    @property
+    def std_duration(self):
+        return math.sqrt(self._m2_duration / self.successful) if self.successful else 0.0
+    
+    def percentiles(self, qs):
+        """Estimated duration percentiles, clamped to the observed min/max."""
+        return np.clip(self.histogram.percentiles(qs), self.min_duration, self.max_duration)
+    
+    def add(self, result):
+        """Fold one result into the summary and return whether it succeeded."""
+        self.total += 1
+        if not result.success:
+            self.failed += 1
+            if len(self.failures) < self.MAX_FAILURES:
+                self.failures.append(result)
+            return False
+        
+        duration = result.duration
+        self.successful += 1
+        self.cache_hits += result.cached
+        self.format_mismatches += result.format_mismatch
+        
+        # Welford's online update of the mean and sum of squared deviations
+        delta = duration - self.mean_duration
+        self.mean_duration += delta / self.successful
+        self._m2_duration += delta * (duration - self.mean_duration)
+        
+        if duration < self.min_duration:
+            self.min_duration = duration
+        if duration > self.max_duration:
+            self.max_duration = duration
+        self.size_sum += result.response_size
+        self.histogram.record(duration)
+        return True
+
+class AudioPack:
+    """Append-only store for saved audio: one pack file plus a tab-separated index.
+    
+    Each index line holds `request_num, voice, offset, size` locating one response
+    in the pack, which replaces thousands of small per-request MP3 files. Both
+    files are truncated when the pack is opened, so they only hold the current
+    run, just as each run used to overwrite the per-request files. Writes
+    run on a single worker thread, keeping them off the event loop and keeping
+    every response contiguous in the pack.
+    """
+    
+    def __init__(self, directory):
+        self.pack_path = Path(directory) / "pack.bin"
+        self.index_path = Path(directory) / "pack.idx"
+        self._pack = open(self.pack_path, "wb", buffering=4 << 20)
+        self._index = open(self.index_path, "w", buffering=1 << 16)
+        self._executor = ThreadPoolExecutor(max_workers=1)
+    
+    def _write(self, request_num, voice, chunks, size):
+        offset = self._pack.tell()
+        self._pack.writelines(chunks)
+        self._index.write(f"{request_num}\t{voice}\t{offset}\t{size}\n")
+    
+    async def append(self, request_num, voice, chunks, size):
+        """Append one response of `size` bytes, given as the chunks it arrived in."""
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(self._executor, self._write, request_num, voice, chunks, size)
+        logger.info("Saved audio for request %d to %s", request_num, self.pack_path)
+    
+    def close(self):
+        self._executor.shutdown(wait=True)
+        self._pack.close()
+        self._index.close()
+
+class ClientPool:
+    """A small set of httpx clients that spreads requests over several connections.
+    
+    httpx sends every request of a client over a single HTTP/2 connection, so
+    one client per connection caps the number of multiplexed streams on each.
+    Each request goes to the client with the fewest requests in flight. If the
+    server only speaks HTTP/1.1, each client opens up to `streams_per_conn`
+    keep-alive connections instead.
+    """
+    
+    def __init__(self, connections, streams_per_conn, **client_kwargs):
+        limits = httpx.Limits(
+            max_connections=streams_per_conn,
+            max_keepalive_connections=streams_per_conn,
+            keepalive_expiry=120
+        )
+        self.clients = [httpx.AsyncClient(http2=True, limits=limits, **client_kwargs) for _ in range(connections)]
+        self._in_flight = [0] * connections
+    
+    @asynccontextmanager
+    async def checkout(self):
+        """Yield the least busy client for the duration of one request."""
+        index = min(range(len(self.clients)), key=self._in_flight.__getitem__)
+        self._in_flight[index] += 1
+        try:
+            yield self.clients[index]
+        finally:
+            self._in_flight[index] -= 1
+    
+    async def __aenter__(self):
+        return self
+    
+    async def __aexit__(self, *exc_info):
+        await asyncio.gather(*(client.aclose() for client in self.clients))
+
+def positive_int(value):
+    """argparse type for options that must be at least 1."""
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"must be a positive integer, got {value}")
+    return number
+
+def setup_logging(verbose=False):
+    """Send log records through a queue so stdout writes happen off the event loop.
+    
+    Per-request logs are only emitted with --verbose; request errors are always shown.
+    Returns the listener, which must be stopped to flush pending records.
+    """
+    global log_listener
+    log_queue = queue.SimpleQueue()
+    handler = logging.StreamHandler(sys.stdout)
+    handler.setFormatter(logging.Formatter("[%(asctime)s.%(msecs)03d] %(message)s", datefmt="%H:%M:%S"))
+    listener = QueueListener(log_queue, handler)
+    
+    logger.addHandler(QueueHandler(log_queue))
+    logger.setLevel(logging.INFO if verbose else logging.WARNING)
+    logger.propagate = False
+    listener.start()
+    log_listener = listener
+    return listener
+
+def flush_logging():
+    """Wait until every log record queued so far has been written out."""
+    if log_listener:
+        # stop() drains the queue and joins the listener thread
+        log_listener.stop()
+        log_listener.start()
+
+async def send_request(pool, url, voice, text_length, request_num, pack=None, use_cache=False):
+    """Send a single API request and return its RequestResult.
+    
+    Successful audio is appended to `pack` (an AudioPack) when one is given.
+    With use_cache, repeated (text, voice, model, speed) combinations are served
+    from CACHE instead of hitting the server.
+    """
+    
+    t0 = time.monotonic()
+    request_time = time.time()
     
     try:
-        print(f"[{request_time}] Starting request {request_num} with voice {voice}")
+        cache_key = None
+        if use_cache:
+            cache_key = (text_length, voice, MODEL, SPEED)
+            audio_data = CACHE.get(cache_key)
+            if audio_data is not None:
+                CACHE.move_to_end(cache_key)
+                if pack:
+                    await pack.append(request_num, voice, [audio_data], len(audio_data))
+                
+                duration = time.monotonic() - t0
+                logger.info("Request %d served from cache: Size: %.1f KB", request_num, len(audio_data) / 1024)
+                return RequestResult(request_num, voice, 200, duration, len(audio_data), request_time, None,
+                                     cached=True)
         
-        async with session.post(
+        logger.info("Starting request %d with voice %s", request_num, voice)
+        
+        async with pool.checkout() as client, client.stream(
+            "POST",
             url, 
-            json=payload, 
-            headers={
-                "Content-Type": "application/json",
-                "Authorization": "Bearer dummy-api-key"
-            }
+            content=PAYLOAD_BYTES[(text_length, voice)]
         ) as response:
-            status = response.status
+            status = response.status_code
+            http_version = response.http_version
             content_type = response.headers.get('Content-Type', '')
             
-            # Read binary audio data
-            audio_data = await response.read()
-            
-            end_time = time.time()
-            duration = end_time - start_time
-            
-            # Optionally save the audio file
-            if save_dir and status == 200 and audio_data:
-                save_path = Path(save_dir) / f"test_{request_num}_{voice}.mp3"
-                with open(save_path, 'wb') as f:
-                    f.write(audio_data)
-                print(f"Saved audio to {save_path}")
-            
-            # Determine success based on response
-            is_success = status == 200 and audio_data and len(audio_data) > 0
-            
-            result = {
-                "request_num": request_num,
-                "voice": voice,
-                "text_length": text_length,
-                "status": status,
-                "duration": duration,
-                "success": is_success,
-                "timestamp": request_time,
-                "content_type": content_type,
-                "response_size": len(audio_data) if audio_data else 0
-            }
-            
-            print(f"[{datetime.now().strftime('%H:%M:%S.%f')[:-3]}] Request {request_num} completed: " +
-                  f"Status {status}, Size: {len(audio_data)/1024:.1f} KB, Duration: {duration:.2f}s")
-            
-            return result
-            
+            # Stream the audio chunk by chunk, keeping only its leading bytes for
+            # a sanity check. The chunks themselves are only kept when the audio
+            # is going to be saved or cached.
+            response_size = 0
+            head = b""
+            chunks = [] if (pack or cache_key) and status == 200 else None
+            async for chunk in response.aiter_bytes(CHUNK_SIZE):
+                if not head:
+                    head = chunk[:AUDIO_HEAD_SIZE]
+                response_size += len(chunk)
+                if chunks is not None:
+                    chunks.append(chunk)
+        
+        duration = time.monotonic() - t0
+        
+        # Determine success based on response
+        error = None
+        format_mismatch = False
+        if status != 200:
+            error = f"HTTP {status}"
+        elif response_size == 0:
+            error = "Empty response"
+        else:
+            # A body that does not match its Content-Type is reported, not failed
+            format_mismatch = not matches_content_type(content_type, head)
+            if format_mismatch:
+                logger.warning("Request %d: body does not look like %s audio (leading bytes %r)",
+                               request_num, content_type or "any", head[:8])
+            if chunks is not None:
+                # Only the cache needs the audio as one bytes object; the pack
+                # writes the chunks as they are
+                if cache_key:
+                    CACHE[cache_key] = b"".join(chunks)
+                    if len(CACHE) > CACHE_MAX_ENTRIES:
+                        CACHE.popitem(last=False)
+                if pack:
+                    await pack.append(request_num, voice, chunks, response_size)
+        
+        logger.info("Request %d completed: Status %d (%s), Size: %.1f KB, Duration: %.2fs",
+                    request_num, status, http_version, response_size / 1024, duration)
+        
+        return RequestResult(request_num, voice, status, duration, response_size, request_time, error,
+                             format_mismatch=format_mismatch)
+        
     except Exception as e:
-        end_time = time.time()
-        duration = end_time - start_time
+        duration = time.monotonic() - t0
+        
+        logger.warning("Request %d error: %s", request_num, e)
+        
+        return RequestResult(request_num, voice, 0, duration, 0, request_time, str(e))
+
+async def write_results(results_queue, results_file):
+    """Append queued results to the JSONL results file until a None sentinel arrives.
+    
+    Results are drained in batches and written from the default thread pool so
+    disk I/O never blocks the event loop.
+    """
+    loop = asyncio.get_running_loop()
+    done = False
+    
+    while not done:
+        batch = [await results_queue.get()]
+        while not results_queue.empty() and len(batch) < RESULTS_BATCH_SIZE:
+            batch.append(results_queue.get_nowait())
         
-        print(f"[{datetime.now().strftime('%H:%M:%S.%f')[:-3]}] Request {request_num} error: {str(e)}")
+        # The sentinel is always the last item queued
+        if batch[-1] is None:
+            batch.pop()
+            done = True
         
-        return {
-            "request_num": request_num,
-            "voice": voice,
-            "text_length": text_length,
-            "status": 0,
-            "duration": duration,
-            "success": False,
-            "timestamp": request_time,
-            "error": str(e),
-            "response_size": 0
-        }
+        lines = [orjson.dumps(r._asdict()) + b"\n" for r in batch]
+        await loop.run_in_executor(None, results_file.writelines, lines)
 
-async def run_test(server_url, text_length="medium", save_audio=False, num_requests=None, concurrency=1):
+async def warm_up_connections(pool, url, count):
+    """Fill the connection pool ahead of the test with `count` cheap parallel GETs.
+    
+    Any response, even an error status, leaves an open keep-alive connection in
+    the pool. Failures are ignored here because the test itself reports them.
+    """
+    async def probe():
+        try:
+            async with pool.checkout() as client:
+                await client.get(url)
+        except (httpx.HTTPError, httpx.InvalidURL, ValueError):
+            pass
+    
+    async with asyncio.TaskGroup() as tg:
+        for _ in range(count):
+            tg.create_task(probe())
+
+async def run_test(server_url, text_length="medium", save_audio=False, num_requests=None, concurrency=1,
+                   use_cache=False, results_path="results.jsonl", h2_streams_per_conn=100, h2_connections=None,
+                   warmup=0):
     """Run the test with specified parameters.
     
     Args:
         server_url: URL of the TTS server
         text_length: Length of test text (short, medium, long)
-        save_audio: Whether to save audio files
+        save_audio: Whether to save audio to test_output/pack.bin
         num_requests: Number of requests to send (None for continuous until failure)
         concurrency: Number of concurrent requests to send
+        use_cache: Serve repeated requests from a client-side response cache
+        results_path: JSONL file that receives one line per request
+        h2_streams_per_conn: Target number of HTTP/2 streams multiplexed per connection
+        h2_connections: Number of connections to spread requests over
+            (None for ceil(concurrency / h2_streams_per_conn))
+        warmup: Number of warmup requests sent first and excluded from the statistics
     """
     
     if not server_url.endswith('/v1/audio/speech'):
         server_url = f"{server_url.rstrip('/')}/v1/audio/speech"
+    warmup_url = server_url[:-len('/v1/audio/speech')] + '/api/queue-size'
     
-    # Create save directory if needed    
-    save_dir = None
+    # Create save directory and audio pack if needed    
+    pack = None
     if save_audio:
         save_dir = Path('test_output')
         save_dir.mkdir(exist_ok=True)
+        pack = AudioPack(save_dir)
+    
+    if h2_connections is None:
+        h2_connections = math.ceil(concurrency / h2_streams_per_conn)
     
     mode = "fixed" if num_requests else "continuous"
     
@@ -140,129 +491,220 @@ async def run_test(server_url, text_length="medium", save_audio=False, num_reque
     if num_requests:
         print(f"Number of requests: {num_requests}")
     print(f"Concurrency level: {concurrency}")
+    if warmup:
+        print(f"Warmup requests: {warmup}")
+    print(f"Connection pool: {h2_connections} x {h2_streams_per_conn} streams")
     if save_audio:
-        print(f"Saving audio files to: {save_dir}")
+        print(f"Saving audio to: {pack.pack_path} (index: {pack.index_path})")
+    if use_cache:
+        print("Client-side response cache: enabled")
+    print(f"Writing results to: {results_path}")
     print("-" * 60)
     
-    results = []
-    start_time = time.time()
+    # Only running statistics stay in memory; every result is streamed to disk
+    stats = RunStats()
+    results_file = open(results_path, "wb", buffering=1 << 20)
+    results_queue = asyncio.Queue(maxsize=RESULTS_QUEUE_SIZE)
+    writer_task = asyncio.create_task(write_results(results_queue, results_file))
     
-    async with aiohttp.ClientSession() as session:
-        if num_requests:
-            # Fixed number of requests mode
-            request_nums = list(range(1, num_requests + 1))
-            
-            # Process requests in batches according to concurrency
-            for i in range(0, len(request_nums), concurrency):
-                batch = request_nums[i:i+concurrency]
-                tasks = []
-                
-                for req_num in batch:
-                    voice = VOICES[(req_num - 1) % len(VOICES)]
-                    tasks.append(send_request(session, server_url, voice, text_length, req_num, save_dir))
-                
-                batch_results = await asyncio.gather(*tasks)
-                results.extend(batch_results)
-                
-                # Check if any request in the batch failed
-                if any(not r["success"] for r in batch_results):
-                    print("Stopping test due to request failure")
-                    break
+    def on_writer_done(task):
+        # A dead writer never drains the queue again: empty it so requests blocked
+        # on a full queue wake up, and let their next record() call raise the error
+        if not task.cancelled() and task.exception():
+            while not results_queue.empty():
+                results_queue.get_nowait()
+    
+    writer_task.add_done_callback(on_writer_done)
+    
+    async def record(result, warmup=False):
+        # Fail the run as soon as the results writer has died (e.g. disk full)
+        if writer_task.done():
+            writer_task.result()
+        
+        # Each result is classified exactly once, here, as it arrives.
+        # Warmup results are written out but kept out of the statistics.
+        if warmup:
+            result = result._replace(warmup=True)
+            success = result.success
         else:
-            # Continuous mode (until failure)
-            request_num = 1
-            failed = False
-            
-            while not failed:
-                tasks = []
+            success = stats.add(result)
+        await results_queue.put(result)
+        return success
+    
+    # HTTP/2 lets concurrent requests multiplex over a handful of connections
+    # instead of opening one TCP+TLS connection per in-flight request. Piling
+    # every stream onto one connection hurts too, so they are spread over
+    # h2_connections connections of about h2_streams_per_conn streams each.
+    try:
+        async with ClientPool(
+            h2_connections,
+            h2_streams_per_conn,
+            headers=HEADERS,
+            timeout=httpx.Timeout(60.0)
+        ) as pool:
+            async def run_phase(request_nums, warmup=False):
+                """Run requests until `request_nums` is exhausted or one fails; return the failure, if any."""
+                # Requests are numbered in ascending order, so cycling gives the same
+                # round-robin voice assignment as indexing by request number
+                voice_cycle = itertools.cycle(VOICES)
+                phase_pack = None if warmup else pack
                 
-                for i in range(concurrency):
-                    curr_req_num = request_num + i
-                    voice = VOICES[(curr_req_num - 1) % len(VOICES)]
-                    tasks.append(send_request(session, server_url, voice, text_length, curr_req_num, save_dir))
+                # Kill switch: set by the first failure, stops dispatching and,
+                # through StopPhase, cancels every request still in flight
+                failure_event = asyncio.Event()
+                slots = asyncio.Semaphore(concurrency)
+                failure = None
                 
-                batch_results = await asyncio.gather(*tasks)
-                results.extend(batch_results)
+                async def run_one(request_num, voice):
+                    nonlocal failure
+                    try:
+                        result = await send_request(
+                            pool, server_url, voice, text_length, request_num, phase_pack, use_cache
+                        )
+                    finally:
+                        slots.release()
+                    if not await record(result, warmup) and not failure_event.is_set():
+                        failure = result
+                        failure_event.set()
+                        raise StopPhase
                 
-                # Check if any request in the batch failed
-                if any(not r["success"] for r in batch_results):
-                    failed = True
+                try:
+                    async with asyncio.TaskGroup() as tg:
+                        for request_num in request_nums:
+                            # Keep exactly `concurrency` requests in flight: a new request
+                            # is dispatched as soon as any running one finishes
+                            await slots.acquire()
+                            if failure_event.is_set():
+                                break
+                            tg.create_task(run_one(request_num, next(voice_cycle)))
+                except* StopPhase:
+                    pass
+                return failure
+            
+            # Pay the TCP/TLS handshakes before the clock starts
+            await warm_up_connections(pool, warmup_url, concurrency)
+            
+            # Warmup requests take the same path but stay out of the statistics
+            warmup_failure = None
+            if warmup:
+                warmup_failure = await run_phase(range(1, warmup + 1), warmup=True)
+                if warmup_failure:
+                    print(f"Stopping test due to warmup failure "
+                          f"(request {warmup_failure.request_num}: {warmup_failure.error})")
+            
+            start_time = time.monotonic()
+            if not warmup_failure:
+                # Fixed mode sends num_requests requests, continuous mode runs until failure
+                request_nums = range(1, num_requests + 1) if num_requests else itertools.count(1)
+                if await run_phase(request_nums):
                     print("Stopping test due to request failure")
-                    break
-                
-                request_num += concurrency
+    finally:
+        try:
+            if not writer_task.done():
+                await results_queue.put(None)
+            await writer_task
+        finally:
+            results_file.close()
+            if pack:
+                pack.close()
     
-    end_time = time.time()
+    end_time = time.monotonic()
     total_duration = end_time - start_time
     
+    # Keep queued request warnings from landing in the middle of the summary
+    flush_logging()
+    
     print("\n" + "=" * 60)
     print(f"Test Results ({text_length} text, {'continuous' if not num_requests else num_requests} requests, {concurrency} concurrency)")
     print("=" * 60)
     
     # Calculate and display statistics
-    successful_reqs = [r for r in results if r["success"]]
-    failed_reqs = [r for r in results if not r["success"]]
-    
-    success_rate = len(successful_reqs) / len(results) * 100 if results else 0
+    success_rate = stats.successful / stats.total * 100 if stats.total else 0
     
     # Calculate response time statistics
-    if successful_reqs:
-        durations = [r["duration"] for r in successful_reqs]
-        avg_duration = statistics.mean(durations)
-        min_duration = min(durations)
-        max_duration = max(durations)
-        median_duration = statistics.median(durations)
+    if stats.successful:
+        avg_duration = stats.mean_duration
+        std_duration = stats.std_duration
+        p50_duration, p90_duration, p95_duration, p99_duration = stats.percentiles([50, 90, 95, 99])
         
         # Calculate response size statistics
-        sizes = [r["response_size"] for r in successful_reqs]
-        avg_size = statistics.mean(sizes) / 1024  # KB
-        total_size = sum(sizes) / (1024 * 1024)  # MB
+        avg_size = stats.size_sum / stats.successful / 1024  # KB
+        total_size = stats.size_sum / (1024 * 1024)  # MB
         
-        print(f"Total Successful Requests: {len(successful_reqs)}")
+        print(f"Total Successful Requests: {stats.successful}")
         print(f"Success Rate: {success_rate:.1f}%")
+        if use_cache:
+            print(f"Cache Hits: {stats.cache_hits}")
+        if stats.format_mismatches:
+            print(f"Audio Format Mismatches: {stats.format_mismatches}")
         print(f"Total Test Duration: {total_duration:.2f} seconds")
         print(f"Average Response Time: {avg_duration:.3f} seconds")
-        print(f"Median Response Time: {median_duration:.3f} seconds")
-        print(f"Min Response Time: {min_duration:.3f} seconds")
-        print(f"Max Response Time: {max_duration:.3f} seconds")
+        print(f"Std Dev Response Time: {std_duration:.3f} seconds")
+        print(f"Median Response Time: {p50_duration:.3f} seconds")
+        print(f"P90 Response Time: {p90_duration:.3f} seconds")
+        print(f"P95 Response Time: {p95_duration:.3f} seconds")
+        print(f"P99 Response Time: {p99_duration:.3f} seconds")
+        print(f"Min Response Time: {stats.min_duration:.3f} seconds")
+        print(f"Max Response Time: {stats.max_duration:.3f} seconds")
         print(f"Average Response Size: {avg_size:.1f} KB")
         print(f"Total Data Transferred: {total_size:.2f} MB")
-        print(f"Requests per Second: {len(results) / total_duration:.2f}")
+        print(f"Requests per Second: {stats.total / total_duration:.2f}")
         print(f"Throughput: {(total_size * 8) / total_duration:.2f} Mbps")
     else:
         print(f"Success Rate: 0%")
         print(f"Total Test Duration: {total_duration:.2f} seconds")
     
     # Show error details for the failures
-    if failed_reqs:
+    if stats.failures:
         print("\nFailure Details:")
-        for i, failed_req in enumerate(failed_reqs[:5]):  # Show up to 5 failures
-            error = failed_req.get("error", f"HTTP {failed_req['status']}")
-            print(f"  Request Number: {failed_req['request_num']}")
-            print(f"  Voice: {failed_req['voice']}")
-            print(f"  Error: {error}")
-            print(f"  Duration: {failed_req['duration']:.2f} seconds")
-            if i < len(failed_reqs) - 1 and i < 4:  # Add separator except after the last one
+        for i, failed_req in enumerate(stats.failures):
+            print(f"  Request Number: {failed_req.request_num}")
+            print(f"  Voice: {failed_req.voice}")
+            print(f"  Started At: {datetime.fromtimestamp(failed_req.timestamp).strftime('%H:%M:%S.%f')[:-3]}")
+            print(f"  Error: {failed_req.error}")
+            print(f"  Duration: {failed_req.duration:.2f} seconds")
+            if i < len(stats.failures) - 1:  # Add separator except after the last one
                 print("  ---")
         
-        if len(failed_reqs) > 5:
-            print(f"  ... and {len(failed_reqs) - 5} more failures")
+        if stats.failed > len(stats.failures):
+            print(f"  ... and {stats.failed - len(stats.failures)} more failures")
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Pressure test for OpenAI TTS API Server")
     parser.add_argument("-u", "--url", type=str, default="http://localhost:7000", help="Server URL")
     parser.add_argument("-t", "--text-length", type=str, choices=["short", "medium", "long"], default="medium", 
                         help="Length of text to use for testing")
-    parser.add_argument("-s", "--save-audio", action="store_true", help="Save audio files to test_output directory")
+    parser.add_argument("-s", "--save-audio", action="store_true", help="Save audio to test_output/pack.bin, indexed by test_output/pack.idx")
     parser.add_argument("-n", "--num-requests", type=int, help="Number of requests to send (default: continuous until failure)")
-    parser.add_argument("-c", "--concurrency", type=int, default=1, help="Number of concurrent requests (default: 1)")
+    parser.add_argument("-c", "--concurrency", type=positive_int, default=1, help="Number of concurrent requests (default: 1)")
+    parser.add_argument("-w", "--warmup", type=int, default=0,
+                        help="Number of warmup requests to send first, excluded from the statistics (default: 0)")
+    parser.add_argument("--cache", action="store_true",
+                        help="Serve repeated text/voice combinations from a client-side cache (measures end-to-end throughput, not server load)")
+    parser.add_argument("-r", "--results-file", type=str, default="results.jsonl",
+                        help="JSONL file receiving one line per request (default: results.jsonl)")
+    parser.add_argument("--h2-streams-per-conn", type=positive_int, default=100,
+                        help="Target number of HTTP/2 streams per connection (default: 100)")
+    parser.add_argument("--h2-connections", type=positive_int,
+                        help="Number of connections to spread requests over (default: ceil(concurrency / streams per connection))")
+    parser.add_argument("-v", "--verbose", action="store_true", help="Log every request as it starts and completes")
     
     args = parser.parse_args()
     
-    asyncio.run(run_test(
-        args.url, 
-        args.text_length,
-        args.save_audio,
-        args.num_requests,
-        args.concurrency
-    )) 
\ No newline at end of file
+    listener = setup_logging(args.verbose)
+    run = uvloop.run if uvloop else asyncio.run
+    try:
+        run(run_test(
+            args.url, 
+            args.text_length,
+            args.save_audio,
+            args.num_requests,
+            args.concurrency,
+            args.cache,
+            args.results_file,
+            args.h2_streams_per_conn,
+            args.h2_connections,
+            args.warmup
+        ))
+    finally:
+        listener.stop() 
\ No newline at end of file